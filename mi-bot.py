@@ -1,19 +1,30 @@
 #!/usr/bin/env python3
 
+import functools
+import glob
 import logging
 import os
-import pickle
 import random
 import re
 import sys
+import textwrap
+import threading
 import time
 import traceback
-from datetime import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime as dt, timezone
+from email.utils import parsedate_to_datetime
+from http.client import HTTPException
 from subprocess import run
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from xml.etree import ElementTree
 
-import feedparser
 import html2markdown
-from fuzzywuzzy import process
+import msgpack
+import numpy as np
+from rapidfuzz import fuzz, process, utils
 from telegram import Update, ParseMode
 from telegram.ext import Updater, CommandHandler, CallbackContext
 
@@ -23,7 +34,15 @@ CHAT_IDS = os.environ['MIA_TG_CHATID'].split(',')
 URL = f"https://api.telegram.org/bot{TOKEN}/"
 DUMP = os.getenv('MIA_DUMP', '')
 DIRNAME = os.path.dirname(os.path.realpath(__file__))
+FORTUNE_DIR = os.getenv('MIA_FORTUNES', '/usr/share/games/fortunes')
 MINKORREKT_RSS = 'http://minkorrekt.de/feed/mp3'
+RSS_CONTENT_TAG = '{http://purl.org/rss/1.0/modules/content/}encoded'
+USER_AGENT = 'mi-announce-bot'
+
+EP_NUM_RE = re.compile(r"(?:Minkorrekt(?: Folge)? |Mi)(\d+\w?)")
+TOPIC_LINE_RE = re.compile(r"Thema [1-4][^\n]*")
+# MarkdownV2 characters which are escaped in broadcasts, unless they already are
+ESCAPE_RE = re.compile(r"(?<!\\)([!#\-])")
 
 
 # Setup logging
@@ -36,6 +55,101 @@ log_handler.setLevel(logging.INFO)
 logger.addHandler(log_handler)
 
 
+@dataclass
+class Episode:
+    """An item of the podcast RSS feed, reduced to the fields used by the bot"""
+
+    title: str
+    link: str
+    published_parsed: time.struct_time  # in UTC
+    content: str
+
+
+def _parse_rss(source):
+    """Extracts the episodes of an RSS feed, streaming over its <item> elements."""
+    entries = []
+    for _, elem in ElementTree.iterparse(source):
+        if elem.tag == 'item':
+            try:
+                published = parsedate_to_datetime(elem.findtext('pubDate'))
+            except (TypeError, ValueError):
+                # Without a release date the item can't be announced, so skip only this one
+                logger.info(f'Skipping feed item without valid pubDate: {elem.findtext("title")}')
+            else:
+                entries.append(Episode(title=elem.findtext('title', ''),
+                                       link=elem.findtext('link', ''),
+                                       published_parsed=published.utctimetuple(),
+                                       content=elem.findtext(RSS_CONTENT_TAG, '')))
+            # Free the already processed subtree
+            elem.clear()
+    return entries
+
+
+def _released(entry):
+    """Release time of a feed entry, whose `published_parsed` is given in UTC."""
+    return dt(*entry.published_parsed[:6], tzinfo=timezone.utc)
+
+
+class FeedSnapshot:
+    """The episodes of one download of the feed, together with the data derived from them.
+
+    A refresh replaces the whole snapshot at once, so handlers which hold on to one
+    snapshot never mix indices of an old feed with the entries of a new one.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        # Filled on demand by episode_topics
+        self._topics = {}
+
+    @functools.cached_property
+    def titles(self):
+        return tuple(i.title for i in self.entries)
+
+    @functools.cached_property
+    def processed_entries(self):
+        """Title and cleaned description of each episode, joined into one string."""
+        return [e.title + " " + e.content.replace(
+            "<!-- /wp:paragraph -->", "").replace("<!-- wp:paragraph -->", "")
+                for e in self.entries]
+
+    @functools.cached_property
+    def normalized_entries(self):
+        """Processed entries, normalized for fuzzy matching with `utils.default_process`."""
+        return [utils.default_process(entry) for entry in self.processed_entries]
+
+    @functools.cached_property
+    def episode_numbers(self):
+        """Episode number parsed from each title, or None if the title has none."""
+        return [m[1] if (m := EP_NUM_RE.match(entry.title)) else None
+                for entry in self.entries]
+
+    @functools.cached_property
+    def episode_index(self):
+        """Maps each episode number to the index of its first entry in the feed."""
+        index = {}
+        for i, number in enumerate(self.episode_numbers):
+            if number is not None:
+                index.setdefault(number, i)
+        return index
+
+    def episode_topics(self, index):
+        """Topic lines of the entry at `index` as markdown, converted once per snapshot."""
+        if index not in self._topics:
+            self._topics[index] = [html2markdown.convert(line) for line in
+                                   TOPIC_LINE_RE.findall(self.processed_entries[index])]
+        return self._topics[index]
+
+    @functools.cached_property
+    def token_index(self):
+        """Maps each word of the normalized entries to the indices containing it."""
+        index = {}
+        for i, entry in enumerate(self.normalized_entries):
+            for token in set(entry.split()):
+                index.setdefault(token, set()).add(i)
+        return index
+
+
 class PodcastFeed:
     """Represents the parsed and cached podcast RSS feed"""
 
@@ -52,11 +166,22 @@ class PodcastFeed:
         self.url = url
         self.max_age = max_age
         self.dump = dump
+        # Validators of the last download, sent along to allow a "304 Not Modified" response
+        self._etag = None
+        self._modified = None
+        # Stays empty only if neither the dump nor the first download could be loaded
+        self.snapshot = FeedSnapshot([])
 
         if dump and os.path.isfile(dump):
             try:
                 with open(dump, 'rb') as f:
-                    self.last_updated, self.feed = pickle.load(f)
+                    dumped = msgpack.unpack(f, raw=False)
+                self.snapshot = FeedSnapshot([
+                    Episode(title, link, time.struct_time(published), content)
+                    for title, link, published, content in dumped['entries']])
+                self.last_updated = dumped['last_updated']
+                self._etag = dumped['etag']
+                self._modified = dumped['modified']
                 logger.info('Reloaded dumped feed')
             except Exception as exc:
                 logger.info(f'{exc!r}\n{traceback.format_exc()}')
@@ -67,12 +192,37 @@ class PodcastFeed:
             self._get_feed()
 
     def _get_feed(self):
-        self.feed = feedparser.parse(self.url)
+        headers = {'User-Agent': USER_AGENT}
+        if self._etag:
+            headers['If-None-Match'] = self._etag
+        if self._modified:
+            headers['If-Modified-Since'] = self._modified
+        try:
+            with urlopen(Request(self.url, headers=headers)) as response:
+                entries = _parse_rss(response)
+                etag = response.headers.get('ETag')
+                modified = response.headers.get('Last-Modified')
+        except (OSError, HTTPException, ElementTree.ParseError) as exc:
+            # Keep the previous entries, and retry only after max_age instead of on every access
+            self.last_updated = time.time()
+            if isinstance(exc, HTTPError) and exc.code == 304:
+                logger.info('Feed not modified')
+            else:
+                logger.info(f'Failed getting feed, keeping previous entries: {exc!r}')
+            return
+        # Replace the entries and all derived data in a single assignment
+        self.snapshot = FeedSnapshot(entries)
         self.last_updated = time.time()
+        self._etag = etag
+        self._modified = modified
         logger.info('Done parsing feed')
         if self.dump:
             with open(self.dump, 'wb') as f:
-                pickle.dump((self.last_updated, self.feed), f)
+                msgpack.pack({'last_updated': self.last_updated,
+                              'etag': self._etag,
+                              'modified': self._modified,
+                              'entries': [(e.title, e.link, tuple(e.published_parsed), e.content)
+                                          for e in entries]}, f, use_bin_type=True)
 
     def refresh(self):
         if self.last_updated + self.max_age < time.time():
@@ -81,33 +231,59 @@ class PodcastFeed:
 
     def check_new_episode(self, max_age=3600):
         latest_episode = self.latest_episode
-        episode_release = dt.fromtimestamp(time.mktime(latest_episode['published_parsed']))
-        if (dt.now() - episode_release).total_seconds() < max_age:
+        if latest_episode is None:
+            return False
+        if (dt.now(timezone.utc) - _released(latest_episode)).total_seconds() < max_age:
             return latest_episode
         return False
 
     @property
     def latest_episode(self):
         self.refresh()
-        return self.feed['items'][0]
+        entries = self.snapshot.entries
+        return entries[0] if entries else None
 
     @property
     def episode_titles(self):
         self.refresh()
-        return [i.title for i in self.feed['items']]
+        return self.snapshot.titles
 
 
 mi_feed = PodcastFeed(url=MINKORREKT_RSS, dump=DUMP)
 
 
-def tg_broadcast(text, escape_chars=['!', '#', '-']):
+class Throttle:
+    """Spaces calls from any number of threads at least `interval` seconds apart"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def wait(self):
+        """Blocks until the caller may proceed, reserving the next free time slot."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+
+# Telegram allows a bot to send about 30 messages per second overall
+send_throttle = Throttle(1 / 30)
+
+
+def send_throttled(chat_id, text):
+    send_throttle.wait()
+    bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.MARKDOWN_V2)
+
+
+def tg_broadcast(text):
     """Sends the message `text` to all CHAT_IDS."""
-    for c in escape_chars:
-        text = re.sub(f'(?<!\\\\){c}', f'\\{c}', text)
-    for chat_id in CHAT_IDS:
-        bot.send_message(chat_id=chat_id,
-                         text=text,
-                         parse_mode=ParseMode.MARKDOWN_V2)
+    text = ESCAPE_RE.sub(r"\\\1", text)
+    # Send concurrently, send_throttled keeps the rate below Telegram's limit
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        list(executor.map(lambda chat_id: send_throttled(chat_id, text), CHAT_IDS))
 
 
 def check_minkorrekt(max_age=3600):
@@ -119,26 +295,32 @@ def check_minkorrekt(max_age=3600):
 
 
 def check_youtube(max_age=3600):
+    # Only needed for the hourly YouTube check, so keep it out of the bot's startup
+    import feedparser
+
     YOUTUBE_RSS = 'https://www.youtube.com/feeds/videos.xml?channel_id=UCa8qyXCS-FTs0fHD6HJeyiw'
     yt_feed = feedparser.parse(YOUTUBE_RSS)
     newest_episode = yt_feed['items'][0]
-    episode_release = dt.fromtimestamp(time.mktime(newest_episode['published_parsed']))
-    if (dt.now() - episode_release).total_seconds() < max_age:
+    if (dt.now(timezone.utc) - _released(newest_episode)).total_seconds() < max_age:
         tg_broadcast(f'*{newest_episode.title}*\n'
                      'Eine neues Youtube Video ist erschienen!\n'
                      f'[Jetzt ansehen]({newest_episode.link})')
 
 
 def feed_loop():
-    while True:
-        check_minkorrekt(3600)
-        check_youtube(3600)
-        time.sleep(3595)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        while True:
+            # Fetch both feeds concurrently, list() re-raises any exception of the checks
+            list(executor.map(lambda check: check(3600), [check_minkorrekt, check_youtube]))
+            time.sleep(3595)
 
 
 def latest_episode(update: Update, context: CallbackContext) -> None:
     latest_episode = mi_feed.latest_episode
-    episode_release = dt.fromtimestamp(time.mktime(latest_episode['published_parsed'])).date()
+    if latest_episode is None:
+        update.message.reply_text('Der Feed konnte gerade nicht geladen werden.', quote=False)
+        return None
+    episode_release = _released(latest_episode).astimezone().date()
     datum = episode_release.strftime('%d.%m.%Y')
     text = (f'Die letzte Episode ist *{latest_episode.title}* vom {datum}.\n'
             f'[Jetzt anhören]({latest_episode.link})')
@@ -150,18 +332,58 @@ def cookie(update: Update, context: CallbackContext) -> None:
     update.message.reply_text(f'\U0001F36A {text} \U0001F36A', quote=False)
 
 
+@functools.lru_cache(maxsize=None)
+def fortunes():
+    """All fortunes of the fortune database, loaded once."""
+    fortunes = []
+    for path in glob.glob(os.path.join(FORTUNE_DIR, '*')):
+        # Skip the .dat/.u8 index files and subdirectories like the offensive ones
+        if '.' in os.path.basename(path) or not os.path.isfile(path):
+            continue
+        with open(path, encoding='utf-8', errors='replace') as f:
+            fortunes.extend(i for i in f.read().split('\n%\n') if i.strip())
+    logger.info(f'Loaded {len(fortunes)} fortunes')
+    return tuple(fortunes)
+
+
+@functools.lru_cache(maxsize=None)
+def crow_drawing():
+    """The crow below cowsay's speech bubble, rendered once."""
+    crowfile = os.path.join(DIRNAME, 'crow.cow')
+    r = run(['cowsay', '-f', crowfile, 'x'], capture_output=True, encoding='utf-8', check=True)
+    # Drop the three lines of the bubble around the placeholder message
+    return r.stdout.split('\n', 3)[3]
+
+
+def cowsay_bubble(text, width=39):
+    """Wraps `text` into a speech bubble the way cowsay does."""
+    # Like cowsay's Text::Wrap::fill, collapse whitespace runs within each paragraph
+    paragraphs = [textwrap.wrap(re.sub(r'\s+', ' ', p), width)
+                  for p in re.split(r'\n\s+', text.expandtabs().strip())]
+    lines = [line for p in paragraphs for line in p + ['']][:-1] or ['']
+    length = max(len(line) for line in lines)
+    if len(lines) == 1:
+        borders = [('<', '>')]
+    else:
+        borders = [('/', '\\')] + [('|', '|')] * (len(lines) - 2) + [('\\', '/')]
+    bubble = [' ' + '_' * (length + 2)]
+    bubble += [f'{left} {line.ljust(length)} {right}'
+               for line, (left, right) in zip(lines, borders)]
+    bubble.append(' ' + '-' * (length + 2))
+    return '\n'.join(bubble)
+
+
 def crowsay(update: Update, context: CallbackContext) -> None:
     i = update.message.text.find(' ')
     if i > 0:
         text = update.message.text[i+1:]
+    elif fortunes():
+        text = random.choice(fortunes())
     else:
         r = run('fortune', capture_output=True, encoding='utf-8')
         text = r.stdout
 
-    crowfile = os.path.join(DIRNAME, 'crow.cow')
-    r = run(['cowsay', '-f', crowfile, text],
-            capture_output=True, encoding='utf-8')
-    text = r.stdout
+    text = f'{cowsay_bubble(text)}\n{crow_drawing()}'
     update.message.reply_text(f'```\n{text}\n```', quote=False, parse_mode=ParseMode.MARKDOWN_V2)
 
 
@@ -169,70 +391,75 @@ def fuzzy_topic_search(update: Update, context: CallbackContext) -> None:
     i = update.message.text.find(' ')
     if i > 0:
         search_term = update.message.text[i+1:]
-    topics_all_episodes = [[i.title, i.content[0].value.replace(
-        "<!-- /wp:paragraph -->", "").replace("<!-- wp:paragraph -->", "")
-                            ] for i in mi_feed.feed.entries]
-    ratios = process.extract(search_term, topics_all_episodes)
-    episodes = [ratio[0][0] for ratio in ratios[:3]]
+    # The corpus is normalized once per feed refresh, so only the query is processed here
+    query = utils.default_process(search_term)
+    # Read every derived list from the same snapshot, even if the feed refreshes meanwhile
+    feed = mi_feed.snapshot
+    normalized_entries = feed.normalized_entries
+    # Only score episodes sharing a word with the search term. If fewer than the three
+    # answered episodes do (e.g. typos), score the whole archive instead.
+    candidates = set()
+    for token in query.split():
+        candidates |= feed.token_index.get(token, set())
+    if len(candidates) >= 3:
+        candidates = sorted(candidates)
+    else:
+        candidates = range(len(normalized_entries))
+    # Score all candidates in one multi-threaded call instead of a Python loop per entry
+    scores = process.cdist([query], [normalized_entries[index] for index in candidates],
+                           scorer=fuzz.WRatio, processor=None,
+                           dtype=np.uint8, workers=-1)[0]
+    neg_scores = -scores.astype(np.int16)
+    # Select the best three in linear time and only sort those
+    if len(neg_scores) > 3:
+        best = np.argpartition(neg_scores, 2)[:3]
+    else:
+        best = np.arange(len(neg_scores))
+    best = best[np.argsort(neg_scores[best], kind='stable')]
+    episodes = [feed.entries[candidates[j]].title for j in best]
     text = "Die besten 3 Treffer sind die Episoden:\n" + "\n".join(episodes)
     update.message.reply_text(text, quote=False, parse_mode=ParseMode.MARKDOWN)
 
 
 def topics_of_episode(update: Update, context: CallbackContext) -> None:
-
-    regex_pattern_episode_number = r"(?:Minkorrekt(?:\ Folge)?\ |Mi)(\d+\w?)"
-
-    # List of titles+description per episode
-    episode_numbers = [re.match(regex_pattern_episode_number, entry.title)[1] if not re.match(
-        regex_pattern_episode_number, entry.title)
-                       is None else None for entry in mi_feed.feed.entries]
-    topics_all_episodes = [[i.title, i.content[0].value.replace(
-        "<!-- /wp:paragraph -->", "").replace("<!-- wp:paragraph -->", "")
-                            ] for i in mi_feed.feed.entries]
-
     i = update.message.text.find(' ')
     if i > 0:
         requested_episode_number = update.message.text[i+1:]
-        if requested_episode_number == '101':
-            import pdb
-            pdb.set_trace()
     else:
         text = "Bitte eine Episodennummer beim Aufruf mit angeben."
         update.message.reply_text(text, quote=False, parse_mode=ParseMode.MARKDOWN)
         return None
+
+    feed = mi_feed.snapshot
+    episode_index = feed.episode_index
     if requested_episode_number == '12':
-        target_episode_index = episode_numbers.index("12a")
-        # Get the entries for 12a and 12b and reverse the order so they're correctly displayed
-        requested_episode_topics = topics_all_episodes[
-            target_episode_index:target_episode_index+1][::-1]
+        target_episode_index = episode_index.get("12a")
     else:
-        try:
-            target_episode_index = episode_numbers.index(requested_episode_number)
-        except Exception:
-            text = f"""Nicht gefunden.\nEpisode {requested_episode_number}
-            gab es möglicherweise nicht."""
-            update.message.reply_text(text, quote=False, parse_mode=ParseMode.MARKDOWN)
-            return None
-        requested_episode_topics = topics_all_episodes[target_episode_index]
-
-    requested_episode_topics = " ".join(requested_episode_topics)
-    topic_start_points = [m.start() for m in re.finditer(
-        "Thema [1, 2, 3, 4]", requested_episode_topics)]
-    topic_end_points = []
-    for start in topic_start_points:
-        topic_end_points.append(start + requested_episode_topics[start:].find('\n'))
-    if 0 == len(topic_start_points):
+        target_episode_index = episode_index.get(requested_episode_number)
+    if target_episode_index is None:
+        text = f"""Nicht gefunden.\nEpisode {requested_episode_number}
+        gab es möglicherweise nicht."""
+        update.message.reply_text(text, quote=False, parse_mode=ParseMode.MARKDOWN)
+        return None
+    if requested_episode_number == '12':
+        # The feed is sorted newest first, so 12b directly precedes 12a
+        requested_episodes = [target_episode_index]
+        if target_episode_index > 0 and feed.episode_numbers[target_episode_index - 1] == "12b":
+            requested_episodes.append(target_episode_index - 1)
+    else:
+        requested_episodes = [target_episode_index]
+
+    topics = [topic for index in requested_episodes for topic in feed.episode_topics(index)]
+    if 0 == len(topics):
         text = "Themen nicht gefunden.\nWahrscheinlich Nobelpreis/Jahresrückblick-Folge"
         update.message.reply_text(text, quote=False, parse_mode=ParseMode.MARKDOWN)
         return None
-    topics = [html2markdown.convert(requested_episode_topics[start:end]) for start, end in zip(
-        topic_start_points, topic_end_points)]
     topics_text = "\n".join(topics)
 
     if requested_episode_number == '12':
         episode_title = "12a Du wirst wieder angerufen! & 12b Previously (on) Lost"
     else:
-        episode_title = topics_all_episodes[target_episode_index][0]
+        episode_title = feed.entries[target_episode_index].title
     text = f"Die Themen von Folge {episode_title} sind:\n{topics_text}"
     update.message.reply_text(text, quote=False, parse_mode=ParseMode.MARKDOWN)
 